@@ -15,19 +15,31 @@
 # SPDX-License-Identifier: Apache-2.0
 
 import asyncio
+import contextlib
 import grpc
+import os
+import shutil
+import socket
+import tempfile
+import threading
 import unittest
 import uuid
 
-from concurrent import futures
-from typing import List, Any, Coroutine, Dict
+from collections import defaultdict, deque
+from typing import List, Any, Coroutine, Deque, Dict, Iterator, Optional, Sequence, Tuple, TypeVar
 
 from pxapi import cloudapi_pb2_grpc, cpb, vizierapi_pb2_grpc, vpb, utils
 import pxapi
 
 import test_utils
 
+T = TypeVar("T")
+
 ACCESS_TOKEN = "12345678-0000-0000-0000-987654321012"
+EXPECTED_HEALTHY_CLUSTERS = frozenset({"cluster1", "cluster2"})
+# The UPID sent in the fake "stats" rows, and the UUID the API decodes it into.
+STATS_UPID = vpb.UInt128(high=123, low=456)
+STATS_UUID = uuid.UUID('00000000-0000-007b-0000-0000000001c8')
 pxl_script = """
 import px
 px.display(px.DataFrame('http_events')[
@@ -37,6 +49,45 @@ px.display(px.DataFrame('process_stats')[
 """
 
 
+HTTP_TABLE_FACTORY = test_utils.FakeTableFactory("http", vpb.Relation(columns=[
+    test_utils.string_col("resp_body"),
+    test_utils.int64_col("resp_status"),
+]))
+
+STATS_TABLE_FACTORY = test_utils.FakeTableFactory("stats", vpb.Relation(columns=[
+    test_utils.uint128_col("upid"),
+    test_utils.int64_col("cpu_ktime_ns"),
+    test_utils.int64_col("rss_bytes"),
+]))
+
+# Pre-built responses for the "http" and "stats" tables that most tests stream. The
+# fake never mutates them, so they're shared across tests.
+_http_table = HTTP_TABLE_FACTORY.create_table(test_utils.table_id1)
+HTTP_META = _http_table.metadata_response()
+HTTP_BATCH_FOO = _http_table.row_batch_response([[b"foo"], [200]])
+HTTP_END = _http_table.end()
+
+_stats_table = STATS_TABLE_FACTORY.create_table(test_utils.table_id3)
+STATS_META = _stats_table.metadata_response()
+STATS_BATCH = _stats_table.row_batch_response([[STATS_UPID], [1000], [999]])
+STATS_END = _stats_table.end()
+
+
+# The fake server is local, so compressing messages would only cost CPU.
+CHANNEL_OPTIONS = [
+    ("grpc.default_compression_algorithm", grpc.Compression.NoCompression.value),
+    ("grpc.default_compression_level", 0),
+]
+
+
+def insecure_channel(url: str) -> grpc.Channel:
+    return grpc.insecure_channel(url, options=CHANNEL_OPTIONS, compression=grpc.Compression.NoCompression)
+
+
+def aio_insecure_channel(url: str) -> grpc.aio.Channel:
+    return grpc.aio.insecure_channel(url, options=CHANNEL_OPTIONS, compression=grpc.Compression.NoCompression)
+
+
 async def run_script_and_tasks(
     script_executor: pxapi.ScriptExecutor,
     processors: List[Coroutine[Any, Any, Any]]
@@ -55,22 +106,55 @@ async def run_script_and_tasks(
     await asyncio.gather(*tasks)
 
 
+VIZIER_SERVICE_NAME = vpb.DESCRIPTOR.services_by_name["VizierService"].full_name
+
+
 class VizierServiceFake(vizierapi_pb2_grpc.VizierServiceServicer):
+    """
+    Streams fake ExecuteScript responses. ExecuteScript yields serialized bytes rather
+    than messages, so the fake must be registered with `add_to_server`, not with
+    `add_VizierServiceServicer_to_server`.
+    """
+
     def __init__(self) -> None:
         self.cluster_id_to_fake_data: Dict[str,
-                                           List[test_utils.ExecResponse]] = {}
+                                           Deque[test_utils.ExecResponse]] = defaultdict(deque)
         self.cluster_id_to_error: Dict[str, Exception] = {}
 
-    def add_fake_data(self, cluster_id: str, data: List[test_utils.ExecResponse]) -> None:
-        if cluster_id not in self.cluster_id_to_fake_data:
-            self.cluster_id_to_fake_data[cluster_id] = []
+    def reset(self) -> None:
+        """ Drops the fake data and errors added by a test. """
+        self.cluster_id_to_fake_data.clear()
+        self.cluster_id_to_error.clear()
+
+    def add_fake_data(self, cluster_id: str, data: Sequence[test_utils.ExecResponse]) -> None:
+        for d in data:
+            # Serialize up front so streaming the response only copies bytes.
+            d.serialized_script_response(None)
         self.cluster_id_to_fake_data[cluster_id].extend(data)
 
+    def set_fake_data(self, cluster_id: str, *responses: test_utils.ExecResponse) -> None:
+        """ Replaces the data streamed for the cluster with `responses`. """
+        self.cluster_id_to_fake_data[cluster_id] = deque()
+        self.add_fake_data(cluster_id, responses)
+
+    def add_coalesced(self, cluster_id: str, table: test_utils.FakeTable, cols: List[List[Any]]) -> None:
+        """
+        Adds a table whose rows and end-of-stream are sent in a single row batch.
+
+        Metadata and data share a oneof in ExecuteScriptResponse, so the metadata still
+        needs its own message.
+        """
+        self.add_fake_data(cluster_id, [
+            table.metadata_response(),
+            table.row_batch_response(cols, eos=True),
+        ])
+
     def trigger_error(self, cluster_id: str, exc: Exception) -> None:
         """ Adds an error that triggers after the data is yielded. """
         self.cluster_id_to_error[cluster_id] = exc
 
-    def ExecuteScript(self, request: vpb.ExecuteScriptRequest, context: Any) -> Any:
+    async def ExecuteScript(self, request: vpb.ExecuteScriptRequest, context: Any) -> Any:
+        """ Yields serialized responses, see `add_to_server`. """
         cluster_id = request.cluster_id
         assert cluster_id in self.cluster_id_to_fake_data, f"need data for cluster_id {cluster_id}"
         data = self.cluster_id_to_fake_data[cluster_id]
@@ -78,12 +162,39 @@ class VizierServiceFake(vizierapi_pb2_grpc.VizierServiceServicer):
         if request.HasField("encryption_options"):
             opts = request.encryption_options
         for d in data:
-            yield d.encrypted_script_response(opts)
+            yield d.serialized_script_response(opts)
 
         # Trigger an error for the cluster ID if the user added one.
         if cluster_id in self.cluster_id_to_error:
             raise self.cluster_id_to_error[cluster_id]
 
+    def add_to_server(self, server: grpc.aio.Server) -> None:
+        """
+        Registers the service with a pass-through response serializer for ExecuteScript,
+        so the pre-serialized responses aren't parsed and serialized again per stream.
+        The other methods keep the generated serializers.
+        """
+        handlers = {
+            "ExecuteScript": grpc.unary_stream_rpc_method_handler(
+                self.ExecuteScript,
+                request_deserializer=vpb.ExecuteScriptRequest.FromString,
+                response_serializer=bytes,
+            ),
+            "HealthCheck": grpc.unary_stream_rpc_method_handler(
+                self.HealthCheck,
+                request_deserializer=vpb.HealthCheckRequest.FromString,
+                response_serializer=vpb.HealthCheckResponse.SerializeToString,
+            ),
+            "GenerateOTelScript": grpc.unary_unary_rpc_method_handler(
+                self.GenerateOTelScript,
+                request_deserializer=vpb.GenerateOTelScriptRequest.FromString,
+                response_serializer=vpb.GenerateOTelScriptResponse.SerializeToString,
+            ),
+        }
+        server.add_generic_rpc_handlers((
+            grpc.method_handlers_generic_handler(VIZIER_SERVICE_NAME, handlers),
+        ))
+
 
 def create_cluster_info(
     cluster_id: str,
@@ -97,126 +208,201 @@ def create_cluster_info(
     )
 
 
+def default_clusters() -> List[cpb.ClusterInfo]:
+    return [
+        create_cluster_info(
+            test_utils.cluster_uuid1,
+            "cluster1",
+        ),
+        create_cluster_info(
+            test_utils.cluster_uuid2,
+            "cluster2",
+        ),
+        # One cluster marked as unhealthy.
+        create_cluster_info(
+            test_utils.cluster_uuid3,
+            "cluster3",
+            status=cpb.CS_UNHEALTHY,
+        ),
+    ]
+
+
 class CloudServiceFake(cloudapi_pb2_grpc.VizierClusterInfoServicer):
     def __init__(self) -> None:
-        self.clusters = [
-            create_cluster_info(
-                test_utils.cluster_uuid1,
-                "cluster1",
-            ),
-            create_cluster_info(
-                test_utils.cluster_uuid2,
-                "cluster2",
-            ),
-            # One cluster marked as unhealthy.
-            create_cluster_info(
-                test_utils.cluster_uuid3,
-                "cluster3",
-                status=cpb.CS_UNHEALTHY,
-            ),
-        ]
+        self.reset()
+
+    def reset(self) -> None:
+        """ Restores the default clusters. """
+        self.set_clusters(default_clusters())
 
-    def GetClusterInfo(
+    def set_clusters(self, clusters: List[cpb.ClusterInfo]) -> None:
+        self.clusters = clusters
+        # Index the clusters by ID so lookups don't compare UUID protos one by one.
+        self._clusters_by_id: Dict[Tuple[int, int], cpb.ClusterInfo] = {
+            (c.id.high_bits, c.id.low_bits): c for c in clusters
+        }
+
+    async def GetClusterInfo(
         self,
         request: cpb.GetClusterInfoRequest,
         context: Any,
     ) -> cpb.GetClusterInfoResponse:
         if request.HasField('id'):
-            for c in self.clusters:
-                if c.id == request.id:
-                    return cpb.GetClusterInfoResponse(clusters=[c])
-            return cpb.GetClusterInfoResponse(clusters=[])
+            c = self._clusters_by_id.get((request.id.high_bits, request.id.low_bits))
+            return cpb.GetClusterInfoResponse(clusters=[c] if c is not None else [])
 
         return cpb.GetClusterInfoResponse(clusters=self.clusters)
 
 
-class TestClient(unittest.TestCase):
-    def setUp(self) -> None:
-        # Create a fake server for the VizierService
-        self.server = grpc.server(futures.ThreadPoolExecutor(max_workers=1))
-        self.fake_vizier_service = VizierServiceFake()
-        self.fake_cloud_service = CloudServiceFake()
-
-        vizierapi_pb2_grpc.add_VizierServiceServicer_to_server(
-            self.fake_vizier_service, self.server)
-
-        cloudapi_pb2_grpc.add_VizierClusterInfoServicer_to_server(
-            self.fake_cloud_service, self.server)
-        self.port = self.server.add_insecure_port("[::]:0")
-        self.server.start()
-
-        self.px_client = pxapi.Client(
+class TestClient(unittest.IsolatedAsyncioTestCase):
+    http_table_factory = HTTP_TABLE_FACTORY
+    stats_table_factory = STATS_TABLE_FACTORY
+
+    # Shared by the tests, set in setUpClass().
+    fake_vizier_service: VizierServiceFake
+    fake_cloud_service: CloudServiceFake
+    server: grpc.aio.Server
+    url: str
+    px_client: pxapi.Client
+    healthy_cluster: pxapi.client.Cluster
+    _server_loop: asyncio.AbstractEventLoop
+    _server_thread: threading.Thread
+    _channels: List[grpc.Channel]
+    # The aio channel of the running test, see asyncSetUp().
+    _aio_channel: Optional[grpc.aio.Channel] = None
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        # Create a fake server for the VizierService, shared by every test in the class.
+        # The asyncio server runs on its own loop in a background thread, so it keeps
+        # serving while the tests block on synchronous calls into pxapi.
+        cls.fake_vizier_service = VizierServiceFake()
+        cls.fake_cloud_service = CloudServiceFake()
+        # Class cleanups also run when setUpClass fails, so each one is registered as
+        # soon as the thing it tears down exists.
+        cls._server_loop = asyncio.new_event_loop()
+        cls.addClassCleanup(cls._server_loop.close)
+        cls._server_thread = threading.Thread(target=cls._server_loop.run_forever, daemon=True)
+        cls._server_thread.start()
+        cls.addClassCleanup(cls._stop_server_loop)
+        socket_dir = None
+        if hasattr(socket, "AF_UNIX"):
+            # Unix socket paths are limited to ~108 bytes, which a deep TMPDIR can exceed,
+            # so the socket gets a short directory of its own under /tmp.
+            socket_dir = tempfile.mkdtemp(prefix="px", dir="/tmp")
+            cls.addClassCleanup(shutil.rmtree, socket_dir, ignore_errors=True)
+        cls.server, cls.url = cls._run_on_server_loop(cls._start_server(socket_dir))
+        cls.addClassCleanup(lambda: cls._run_on_server_loop(cls.server.stop(None)))
+
+        # Share one client, and therefore one cloud channel, across the tests. Each test
+        # opens a single aio channel for its connections, see asyncSetUp().
+        cls._channels = []
+        cls.addClassCleanup(cls._close_channels)
+        cls.px_client = pxapi.Client(
             token=ACCESS_TOKEN,
-            server_url=self.url(),
-            channel_fn=lambda url: grpc.insecure_channel(url),
-            conn_channel_fn=lambda url: grpc.aio.insecure_channel(url),
+            server_url=cls.url,
+            channel_fn=cls._create_channel,
+            conn_channel_fn=cls._conn_channel,
         )
+        # The fake cloud's clusters are the same for every test, so list them once.
+        cls.healthy_cluster = cls.px_client.list_healthy_clusters()[0]
 
-        self.http_table_factory = test_utils.FakeTableFactory("http", vpb.Relation(columns=[
-            test_utils.string_col("resp_body"),
-            test_utils.int64_col("resp_status"),
-        ]))
+    @classmethod
+    async def _start_server(cls, socket_dir: Optional[str]) -> Tuple[grpc.aio.Server, str]:
+        server = grpc.aio.server(compression=grpc.Compression.NoCompression)
+        cls.fake_vizier_service.add_to_server(server)
 
-        self.stats_table_factory = test_utils.FakeTableFactory("stats", vpb.Relation(columns=[
-            test_utils.uint128_col("upid"),
-            test_utils.int64_col("cpu_ktime_ns"),
-            test_utils.int64_col("rss_bytes"),
-        ]))
-        asyncio.set_event_loop(asyncio.new_event_loop())
-
-    def url(self) -> str:
-        return f"localhost:{self.port}"
+        cloudapi_pb2_grpc.add_VizierClusterInfoServicer_to_server(
+            cls.fake_cloud_service, server)
+        if socket_dir is not None:
+            # Serve over a unix domain socket so RPCs skip the TCP loopback stack.
+            address = "unix:" + os.path.join(socket_dir, "s.sock")
+            try:
+                server.add_insecure_port(address)
+            except RuntimeError:
+                # The socket can't be created, serve over TCP instead.
+                address = f"localhost:{server.add_insecure_port('[::]:0')}"
+        else:
+            address = f"localhost:{server.add_insecure_port('[::]:0')}"
+        await server.start()
+        return server, address
+
+    @classmethod
+    def _stop_server_loop(cls) -> None:
+        cls._server_loop.call_soon_threadsafe(cls._server_loop.stop)
+        cls._server_thread.join()
+
+    @classmethod
+    def _close_channels(cls) -> None:
+        for c in cls._channels:
+            c.close()
+
+    @classmethod
+    def _run_on_server_loop(cls, coro: Coroutine[Any, Any, T]) -> T:
+        return asyncio.run_coroutine_threadsafe(coro, cls._server_loop).result()
+
+    @classmethod
+    def _create_channel(cls, url: str) -> grpc.Channel:
+        channel = insecure_channel(url)
+        cls._channels.append(channel)
+        return channel
+
+    @classmethod
+    def _conn_channel(cls, url: str) -> grpc.aio.Channel:
+        assert url == cls.url, f"connection to unexpected address {url}"
+        assert cls._aio_channel is not None, "connections can only be made while a test runs"
+        return cls._aio_channel
 
-    def tearDown(self) -> None:
-        self.server.stop(None)
+    def setUp(self) -> None:
+        # The server is shared by the class, only the state of the fakes is per test.
+        self.fake_vizier_service.reset()
+        self.fake_cloud_service.reset()
+
+    async def asyncSetUp(self) -> None:
+        # aio channels are bound to the loop they're created on, so they can only
+        # be reused within a test.
+        type(self)._aio_channel = aio_insecure_channel(self.url)
+
+    async def asyncTearDown(self) -> None:
+        if self._aio_channel is not None:
+            await self._aio_channel.close()
+        type(self)._aio_channel = None
+
+    @contextlib.contextmanager
+    def assertAioRpcError(self, code: grpc.StatusCode, details: str) -> Iterator[None]:
+        """ Asserts that the block raises an AioRpcError with `code` and `details` in its details. """
+        with self.assertRaises(grpc.aio.AioRpcError) as cm:
+            yield
+        self.assertEqual(cm.exception.code(), code)
+        self.assertIn(details, cm.exception.details())
 
     def test_list_and_run_healthy_clusters(self) -> None:
         # Tests that users can list healthy clusters and then
         # execute a script on those clusters.
 
         clusters = self.px_client.list_healthy_clusters()
-        self.assertSetEqual(
-            set([c.name() for c in clusters]),
-            {"cluster1", "cluster2"}
-        )
+        self.assertEqual({c.name() for c in clusters}, EXPECTED_HEALTHY_CLUSTERS)
 
         # Connect to a single fake cluster.
         conn = self.px_client.connect_to_cluster(clusters[0])
 
-        # Create one http table.
+        # Create one http table, sending its data and end-of-stream in one batch.
         http_table1 = self.http_table_factory.create_table(test_utils.table_id1)
-        self.fake_vizier_service.add_fake_data(conn.cluster_id, [
-            # Init "http".
-            http_table1.metadata_response(),
-            # Send data for "http".
-            http_table1.row_batch_response([[b"foo"], [200]]),
-            # End "http".
-            http_table1.end(),
-        ])
+        self.fake_vizier_service.add_coalesced(conn.cluster_id, http_table1, [[b"foo"], [200]])
 
-        script_executor = self.px_client.connect_to_cluster(
-            clusters[0]).prepare_script(pxl_script)
+        script_executor = conn.prepare_script(pxl_script)
 
         script_executor.add_callback("http", lambda row: None)
 
         # Run the script_executor synchronously.
         script_executor.run()
 
-    def test_one_conn_one_table(self) -> None:
+    async def test_one_conn_one_table(self) -> None:
         # Connect to a single fake cluster.
-        conn = self.px_client.connect_to_cluster(
-            self.px_client.list_healthy_clusters()[0])
+        conn = self.px_client.connect_to_cluster(self.healthy_cluster)
 
-        # Create table for cluster_uuid1.
-        http_table1 = self.http_table_factory.create_table(test_utils.table_id1)
-        self.fake_vizier_service.add_fake_data(conn.cluster_id, [
-            # Initialize the table on the stream with the metadata.
-            http_table1.metadata_response(),
-            # Send over a single-row batch.
-            http_table1.row_batch_response([[b"foo"], [200]]),
-            # Send an end-of-stream for the table.
-            http_table1.end(),
-        ])
+        # Send the metadata, a single-row batch and an end-of-stream for "http".
+        self.fake_vizier_service.set_fake_data(conn.cluster_id, HTTP_META, HTTP_BATCH_FOO, HTTP_END)
 
         # Create the script_executor object.
         script_executor = conn.prepare_script(pxl_script)
@@ -235,15 +421,12 @@ class TestClient(unittest.TestCase):
             self.assertEqual(num_rows, 1)
 
         # Run the script_executor and process_table concurrently.
-        loop = asyncio.get_event_loop()
-        loop.run_until_complete(
-            run_script_and_tasks(script_executor, [process_table(http_tb)]))
+        await run_script_and_tasks(script_executor, [process_table(http_tb)])
 
-    def test_multiple_rows_and_rowbatches(self) -> None:
+    async def test_multiple_rows_and_rowbatches(self) -> None:
 
         # Connect to a single fake cluster.
-        conn = self.px_client.connect_to_cluster(
-            self.px_client.list_healthy_clusters()[0])
+        conn = self.px_client.connect_to_cluster(self.healthy_cluster)
 
         # Create table for the first cluster.
         http_table1 = self.http_table_factory.create_table(test_utils.table_id1)
@@ -251,7 +434,8 @@ class TestClient(unittest.TestCase):
             [b"foo", b"bar", b"baz", b"bat"], [200, 500, 301, 404]]
 
         # Here we split the above data into two rowbatches.
-        self.fake_vizier_service.add_fake_data(conn.cluster_id, [
+        self.fake_vizier_service.set_fake_data(
+            conn.cluster_id,
             # Initialize the table on the stream with the metadata.
             http_table1.metadata_response(),
             # Row batch 1 has data 1-3,
@@ -260,7 +444,7 @@ class TestClient(unittest.TestCase):
             http_table1.row_batch_response([rb_data[0][3:], rb_data[1][3:]]),
             # Send an end-of-stream for the table.
             http_table1.end(),
-        ])
+        )
 
         # Create the script_executor object.
         script_executor = conn.prepare_script(pxl_script)
@@ -270,48 +454,36 @@ class TestClient(unittest.TestCase):
         # Verify that the rows returned by the table_sub match the
         # order and values of the input test data.
         async def process_table(table_sub: pxapi.TableSub) -> None:
-            row_i = 0
             # table_sub hides the batched rows and delivers them in
             # the same order as the batches sent.
-            async for row in table_sub:
-                self.assertEqual(row["resp_body"], rb_data[0][row_i])
-                self.assertEqual(row["resp_status"], rb_data[1][row_i])
-                row_i += 1
-
-            self.assertEqual(row_i, 4)
+            rows = [row async for row in table_sub]
+            self.assertEqual([row["resp_body"] for row in rows], rb_data[0])
+            self.assertEqual([row["resp_status"] for row in rows], rb_data[1])
 
         # Run the script_executor and process_table concurrently.
-        loop = asyncio.get_event_loop()
-        loop.run_until_complete(
-            run_script_and_tasks(script_executor, [process_table(http_tb)]))
+        await run_script_and_tasks(script_executor, [process_table(http_tb)])
 
-    def test_one_conn_two_tables(self) -> None:
+    async def test_one_conn_two_tables(self) -> None:
 
         # Connect to a single fake cluster.
-        conn = self.px_client.connect_to_cluster(
-            self.px_client.list_healthy_clusters()[0])
+        conn = self.px_client.connect_to_cluster(self.healthy_cluster)
 
         # We will send two tables for this test "http" and "stats".
-        http_table1 = self.http_table_factory.create_table(test_utils.table_id1)
-        stats_table1 = self.stats_table_factory.create_table(test_utils.table_id3)
-        self.fake_vizier_service.add_fake_data(conn.cluster_id, [
+        self.fake_vizier_service.set_fake_data(
+            conn.cluster_id,
             # Initialize "http" on the stream.
-            http_table1.metadata_response(),
+            HTTP_META,
             # Send over a row-batch from "http".
-            http_table1.row_batch_response([[b"foo"], [200]]),
+            HTTP_BATCH_FOO,
             # Initialize "stats" on the stream.
-            stats_table1.metadata_response(),
+            STATS_META,
             # Send over a row-batch from "stats".
-            stats_table1.row_batch_response([
-                [vpb.UInt128(high=123, low=456)],
-                [1000],
-                [999],
-            ]),
+            STATS_BATCH,
             # Send an end-of-stream for "http".
-            http_table1.end(),
+            HTTP_END,
             # Send an end-of-stream for "stats".
-            stats_table1.end(),
-        ])
+            STATS_END,
+        )
 
         script_executor = conn.prepare_script(pxl_script)
         # Subscribe to both tables.
@@ -332,35 +504,31 @@ class TestClient(unittest.TestCase):
         async def process_stats_tb(table_sub: pxapi.TableSub) -> None:
             num_rows = 0
             async for row in table_sub:
-                self.assertEqual(row["upid"], uuid.UUID(
-                    '00000000-0000-007b-0000-0000000001c8'))
+                self.assertEqual(row["upid"], STATS_UUID)
                 self.assertEqual(row["cpu_ktime_ns"], 1000)
                 self.assertEqual(row["rss_bytes"], 999)
                 num_rows += 1
 
             self.assertEqual(num_rows, 1)
         # Run the script_executor and the processing tasks concurrently.
-        loop = asyncio.get_event_loop()
-        loop.run_until_complete(
-            run_script_and_tasks(script_executor, [
-                process_http_tb(http_tb),
-                process_stats_tb(stats_tb)
-            ])
-        )
+        await run_script_and_tasks(script_executor, [
+            process_http_tb(http_tb),
+            process_stats_tb(stats_tb)
+        ])
 
     def test_run_script_with_invalid_arg_error(self) -> None:
 
         # Connect to a single fake cluster.
-        conn = self.px_client.connect_to_cluster(
-            self.px_client.list_healthy_clusters()[0])
+        conn = self.px_client.connect_to_cluster(self.healthy_cluster)
 
         # Send over an error in the Status field. This is the exact error you would
         # get if you sent over an empty pxl function in the ExecuteScriptRequest.
-        self.fake_vizier_service.add_fake_data(conn.cluster_id, [
+        self.fake_vizier_service.set_fake_data(
+            conn.cluster_id,
             test_utils.ExecResponse(vpb.ExecuteScriptResponse(status=test_utils.invalid_argument(
                 message="Script should not be empty."
             )))
-        ])
+        )
 
         # Prepare the script_executor and run synchronously.
         script_executor = conn.prepare_script("")
@@ -373,18 +541,18 @@ class TestClient(unittest.TestCase):
     def test_run_script_with_line_col_error(self) -> None:
 
         # Connect to a single fake cluster.
-        conn = self.px_client.connect_to_cluster(
-            self.px_client.list_healthy_clusters()[0])
+        conn = self.px_client.connect_to_cluster(self.healthy_cluster)
 
         # Send over an error a line, column error. These kinds of errors come
         # from the compiler pointing to a specific failure in the pxl script_executor.
-        self.fake_vizier_service.add_fake_data(conn.cluster_id, [
+        self.fake_vizier_service.set_fake_data(
+            conn.cluster_id,
             test_utils.ExecResponse(vpb.ExecuteScriptResponse(status=test_utils.line_col_error(
                 1,
                 2,
                 message="name 'aa' is not defined"
             )))
-        ])
+        )
 
         # Prepare the script_executor and run synchronously.
         script_executor = conn.prepare_script("aa")
@@ -394,19 +562,13 @@ class TestClient(unittest.TestCase):
         with self.assertRaisesRegex(pxapi.PxLError, "PxL, line 1.*name 'aa' is not defined"):
             script_executor.run()
 
-    def test_run_script_with_api_errors(self) -> None:
+    async def test_run_script_with_api_errors(self) -> None:
 
         # Connect to a single fake cluster.
-        conn = self.px_client.connect_to_cluster(
-            self.px_client.list_healthy_clusters()[0])
+        conn = self.px_client.connect_to_cluster(self.healthy_cluster)
 
         # Only send data for "http".
-        http_table1 = self.http_table_factory.create_table(test_utils.table_id1)
-        self.fake_vizier_service.add_fake_data(conn.cluster_id, [
-            http_table1.metadata_response(),
-            http_table1.row_batch_response([[b"foo"], [200]]),
-            http_table1.end(),
-        ])
+        self.fake_vizier_service.set_fake_data(conn.cluster_id, HTTP_META, HTTP_BATCH_FOO, HTTP_END)
 
         script_executor = conn.prepare_script(pxl_script)
 
@@ -415,10 +577,8 @@ class TestClient(unittest.TestCase):
 
         # Try to pull data from the foobar_tb, but error out when the script_executor
         # never produces that data.
-        loop = asyncio.get_event_loop()
         with self.assertRaisesRegex(ValueError, "Table 'foobar' not received"):
-            loop.run_until_complete(
-                run_script_and_tasks(script_executor, [test_utils.iterate_and_pass(foobar_tb)]))
+            await run_script_and_tasks(script_executor, [test_utils.iterate_and_pass(foobar_tb)])
 
     def test_run_script_callback(self) -> None:
         # Test the callback API. Callback API is a simpler alternative to the TableSub
@@ -426,30 +586,24 @@ class TestClient(unittest.TestCase):
         # can process data without worrying about async processing by using this API.
 
         # Connect to a single fake cluster.
-        conn = self.px_client.connect_to_cluster(
-            self.px_client.list_healthy_clusters()[0])
+        conn = self.px_client.connect_to_cluster(self.healthy_cluster)
 
         # Create two tables: "http" and "stats"
-        http_table1 = self.http_table_factory.create_table(test_utils.table_id1)
-        stats_table1 = self.stats_table_factory.create_table(test_utils.table_id3)
-        self.fake_vizier_service.add_fake_data(conn.cluster_id, [
+        self.fake_vizier_service.set_fake_data(
+            conn.cluster_id,
             # Init "http".
-            http_table1.metadata_response(),
+            HTTP_META,
             # Send data for "http".
-            http_table1.row_batch_response([[b"foo"], [200]]),
+            HTTP_BATCH_FOO,
             # Init "stats".
-            stats_table1.metadata_response(),
+            STATS_META,
             # Send data for "stats".
-            stats_table1.row_batch_response([
-                [vpb.UInt128(high=123, low=456)],
-                [1000],
-                [999],
-            ]),
+            STATS_BATCH,
             # End "http".
-            http_table1.end(),
+            HTTP_END,
             # End "stats".
-            stats_table1.end(),
-        ])
+            STATS_END,
+        )
 
         script_executor = conn.prepare_script(pxl_script)
         http_counter = 0
@@ -467,8 +621,7 @@ class TestClient(unittest.TestCase):
         def stats_fn(row: pxapi.Row) -> None:
             nonlocal stats_counter
             stats_counter += 1
-            self.assertEqual(row["upid"], uuid.UUID(
-                '00000000-0000-007b-0000-0000000001c8'))
+            self.assertEqual(row["upid"], STATS_UUID)
             self.assertEqual(row["cpu_ktime_ns"], 1000)
             self.assertEqual(row["rss_bytes"], 999)
         script_executor.add_callback("stats", stats_fn)
@@ -484,16 +637,11 @@ class TestClient(unittest.TestCase):
         # Test to demonstrate how errors raised in callbacks can be handled.
 
         # Connect to a single fake cluster.
-        conn = self.px_client.connect_to_cluster(
-            self.px_client.list_healthy_clusters()[0])
+        conn = self.px_client.connect_to_cluster(self.healthy_cluster)
 
         # Create HTTP table and add to the stream.
         http_table1 = self.http_table_factory.create_table(test_utils.table_id1)
-        self.fake_vizier_service.add_fake_data(conn.cluster_id, [
-            http_table1.metadata_response(),
-            http_table1.row_batch_response([[b"foo"], [200]]),
-            http_table1.end(),
-        ])
+        self.fake_vizier_service.add_coalesced(conn.cluster_id, http_table1, [[b"foo"], [200]])
 
         script_executor = conn.prepare_script(pxl_script)
 
@@ -506,28 +654,22 @@ class TestClient(unittest.TestCase):
         with self.assertRaisesRegex(ValueError, "random internal error"):
             script_executor.run()
 
-    def test_subscribe_all(self) -> None:
+    async def test_subscribe_all(self) -> None:
         # Tests `subscribe_all_tables()`.
 
         # Connect to a single fake cluster.
-        conn = self.px_client.connect_to_cluster(
-            self.px_client.list_healthy_clusters()[0])
+        conn = self.px_client.connect_to_cluster(self.healthy_cluster)
 
         # Create two tables and simulate them sent over as part of the ExecuteScript call.
-        http_table1 = self.http_table_factory.create_table(test_utils.table_id1)
-        stats_table1 = self.stats_table_factory.create_table(test_utils.table_id3)
-        self.fake_vizier_service.add_fake_data(conn.cluster_id, [
-            http_table1.metadata_response(),
-            http_table1.row_batch_response([[b"foo"], [200]]),
-            stats_table1.metadata_response(),
-            stats_table1.row_batch_response([
-                [vpb.UInt128(high=123, low=456)],
-                [1000],
-                [999],
-            ]),
-            http_table1.end(),
-            stats_table1.end(),
-        ])
+        self.fake_vizier_service.set_fake_data(
+            conn.cluster_id,
+            HTTP_META,
+            HTTP_BATCH_FOO,
+            STATS_META,
+            STATS_BATCH,
+            HTTP_END,
+            STATS_END,
+        )
         # Create script_executor.
         script_executor = conn.prepare_script(pxl_script)
         # Get a subscription to all of the tables that arrive over the stream.
@@ -558,9 +700,7 @@ class TestClient(unittest.TestCase):
 
         # Run the script_executor and process_all_tables function concurrently.
         # We expect no errors.
-        loop = asyncio.get_event_loop()
-        loop.run_until_complete(
-            run_script_and_tasks(script_executor, [process_all_tables(tables())]))
+        await run_script_and_tasks(script_executor, [process_all_tables(tables())])
 
     def test_subscribe_same_table_twice(self) -> None:
         # Only on subscription allowed per table. Users should handle data from
@@ -568,8 +708,7 @@ class TestClient(unittest.TestCase):
         # of multiple subscriptions to one table.
 
         # Connect to a single fake cluster.
-        conn = self.px_client.connect_to_cluster(
-            self.px_client.list_healthy_clusters()[0])
+        conn = self.px_client.connect_to_cluster(self.healthy_cluster)
 
         script_executor = conn.prepare_script(pxl_script)
 
@@ -586,19 +725,9 @@ class TestClient(unittest.TestCase):
         # raise an error.
 
         # Connect to a single fake cluster.
-        conn = self.px_client.connect_to_cluster(
-            self.px_client.list_healthy_clusters()[0])
-
-        stats_table1 = self.stats_table_factory.create_table(test_utils.table_id3)
-        self.fake_vizier_service.add_fake_data(conn.cluster_id, [
-            stats_table1.metadata_response(),
-            stats_table1.row_batch_response([
-                [vpb.UInt128(high=123, low=456)],
-                [1000],
-                [999],
-            ]),
-            stats_table1.end(),
-        ])
+        conn = self.px_client.connect_to_cluster(self.healthy_cluster)
+
+        self.fake_vizier_service.set_fake_data(conn.cluster_id, STATS_META, STATS_BATCH, STATS_END)
 
         script_executor = conn.prepare_script(pxl_script)
 
@@ -625,8 +754,7 @@ class TestClient(unittest.TestCase):
         with self.assertRaisesRegex(ValueError, script_ran_message):
             script_executor.run()
         # Async run should error out.
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
+        loop = asyncio.get_event_loop()
         with self.assertRaisesRegex(ValueError, script_ran_message):
             loop.run_until_complete(script_executor.run_async())
 
@@ -635,21 +763,20 @@ class TestClient(unittest.TestCase):
 
         # Connect to a single fake cluster.
         # Connect to a single fake cluster.
-        conn = self.px_client.connect_to_cluster(
-            self.px_client.list_healthy_clusters()[0])
+        conn = self.px_client.connect_to_cluster(self.healthy_cluster)
 
-        http_table1 = self.http_table_factory.create_table(test_utils.table_id1)
-        self.fake_vizier_service.add_fake_data(conn.cluster_id, [
+        self.fake_vizier_service.set_fake_data(
+            conn.cluster_id,
             # Initialize the table on the stream and send over a rowbatch.
-            http_table1.metadata_response(),
-            http_table1.row_batch_response([[b"foo"], [200]]),
+            HTTP_META,
+            HTTP_BATCH_FOO,
             # Send over an error on the stream after we've started sending data.
             # this should happen if something breaks on the Pixie side.
             # Note: the table does not send an end message over the stream.
             test_utils.ExecResponse(vpb.ExecuteScriptResponse(status=test_utils.invalid_argument(
                 message="server error"
             ))),
-        ])
+        )
 
         # Create the script_executor object.
         script_executor = conn.prepare_script(pxl_script)
@@ -659,21 +786,20 @@ class TestClient(unittest.TestCase):
         with self.assertRaisesRegex(ValueError, "server error"):
             script_executor.run()
 
-    def test_stop_sending_data_before_eos(self) -> None:
+    async def test_stop_sending_data_before_eos(self) -> None:
         # If the stream stops before sending over an eos for each table that should be an error.
 
         # Connect to a single fake cluster.
         # Connect to a single fake cluster.
-        conn = self.px_client.connect_to_cluster(
-            self.px_client.list_healthy_clusters()[0])
+        conn = self.px_client.connect_to_cluster(self.healthy_cluster)
 
-        http_table1 = self.http_table_factory.create_table(test_utils.table_id1)
-        self.fake_vizier_service.add_fake_data(conn.cluster_id, [
+        self.fake_vizier_service.set_fake_data(
+            conn.cluster_id,
             # Initialize the table on the stream and send over a rowbatch.
-            http_table1.metadata_response(),
-            http_table1.row_batch_response([[b"foo"], [200]]),
+            HTTP_META,
+            HTTP_BATCH_FOO,
             # Note: the table does not send an end message over the stream.
-        ])
+        )
 
         # Create the script_executor object.
         script_executor = conn.prepare_script(pxl_script)
@@ -681,65 +807,57 @@ class TestClient(unittest.TestCase):
         http_tb = script_executor.subscribe("http")
 
         # Run the script_executor and process_table concurrently.
-        loop = asyncio.get_event_loop()
         with self.assertRaisesRegex(ValueError, "Closed before receiving end-of-stream."):
-            loop.run_until_complete(
-                run_script_and_tasks(script_executor, [test_utils.iterate_and_pass(http_tb)]))
+            await run_script_and_tasks(script_executor, [test_utils.iterate_and_pass(http_tb)])
 
-    def test_handle_server_side_errors(self) -> None:
+    async def test_handle_server_side_errors(self) -> None:
         # Test to make sure server side errors are handled somewhat.
 
         # Connect to a single fake cluster.
-        conn = self.px_client.connect_to_cluster(
-            self.px_client.list_healthy_clusters()[0])
+        conn = self.px_client.connect_to_cluster(self.healthy_cluster)
 
-        http_table1 = self.http_table_factory.create_table(test_utils.table_id1)
-        self.fake_vizier_service.add_fake_data(conn.cluster_id, [
+        self.fake_vizier_service.set_fake_data(
+            conn.cluster_id,
             # Initialize the table on the stream with the metadata.
-            http_table1.metadata_response(),
+            HTTP_META,
             # Send over a single-row batch.
-            http_table1.row_batch_response([[b"foo"], [200]]),
+            HTTP_BATCH_FOO,
             # NOTE: don't send over the eos -> simulating error midway through
             # stream.
 
-        ])
-        self.fake_vizier_service.trigger_error(
-            test_utils.cluster_uuid1, ValueError('hi'))
+        )
+        self.fake_vizier_service.trigger_error(conn.cluster_id, ValueError('hi'))
         # Create the script_executor object.
         script_executor = conn.prepare_script(pxl_script)
         # Subscribe to the http table.
         http_tb = script_executor.subscribe("http")
 
         # Run the script_executor and process_table concurrently.
-        loop = asyncio.get_event_loop()
-        with self.assertRaisesRegex(grpc.aio.AioRpcError, "hi"):
-            loop.run_until_complete(
-                run_script_and_tasks(script_executor, [test_utils.iterate_and_pass(http_tb)]))
+        with self.assertAioRpcError(grpc.StatusCode.UNKNOWN, "hi"):
+            await run_script_and_tasks(script_executor, [test_utils.iterate_and_pass(http_tb)])
 
     def test_ergo_api(self) -> None:
         # Create a new API where we can run and get results for a table simultaneously.
         # Connect to a cluster.
-        conn = self.px_client.connect_to_cluster(
-            self.px_client.list_healthy_clusters()[0])
+        conn = self.px_client.connect_to_cluster(self.healthy_cluster)
 
         # Create the script_executor.
         script_executor = conn.prepare_script(pxl_script)
 
-        # Create table for cluster_uuid1.
+        # Send all of the rows for "http" in one batch, rather than a batch per row.
+        num_rows = 256
         http_table1 = self.http_table_factory.create_table(test_utils.table_id1)
-        self.fake_vizier_service.add_fake_data(conn.cluster_id, [
-            # Initialize the table on the stream with the metadata.
+        self.fake_vizier_service.set_fake_data(
+            conn.cluster_id,
             http_table1.metadata_response(),
-            # Send over a single-row batch.
-            http_table1.row_batch_response([[b"foo"], [200]]),
-            # Send an end-of-stream for the table.
+            http_table1.row_batch_response([[b"foo"] * num_rows, [200] * num_rows]),
             http_table1.end(),
-        ])
+        )
 
         # Use the results API to run and get the data from the http table.
-        for row in script_executor.results("http"):
-            self.assertEqual(row["resp_body"], b"foo")
-            self.assertEqual(row["resp_status"], 200)
+        rows = list(script_executor.results("http"))
+        self.assertEqual([row["resp_body"] for row in rows], [b"foo"] * num_rows)
+        self.assertEqual([row["resp_status"] for row in rows], [200] * num_rows)
 
     def test_shared_grpc_channel_for_cloud(self) -> None:
         # Make sure the shraed grpc channel are actually shared.
@@ -749,14 +867,14 @@ class TestClient(unittest.TestCase):
             # Nonlocal because we're incrementing the outer variable.
             nonlocal num_create_channel_calls
             num_create_channel_calls += 1
-            return grpc.insecure_channel(url)
+            return insecure_channel(url)
 
         px_client = pxapi.Client(
             token=ACCESS_TOKEN,
-            server_url=self.url(),
+            server_url=self.url,
             # Channel functions for testing.
             channel_fn=cloud_channel_fn,
-            conn_channel_fn=lambda url: grpc.aio.insecure_channel(url),
+            conn_channel_fn=aio_insecure_channel,
         )
 
         # Connect to a cluster.
@@ -776,10 +894,10 @@ class TestClient(unittest.TestCase):
         # Test creating encrypted clients.
         px_client = pxapi.Client(
             token=ACCESS_TOKEN,
-            server_url=self.url(),
+            server_url=self.url,
             use_encryption=True,
-            channel_fn=lambda url: grpc.insecure_channel(url),
-            conn_channel_fn=lambda url: grpc.aio.insecure_channel(url),
+            channel_fn=insecure_channel,
+            conn_channel_fn=aio_insecure_channel,
         )
         conn = px_client.connect_to_cluster(
             px_client.list_healthy_clusters()[0])
@@ -789,16 +907,8 @@ class TestClient(unittest.TestCase):
 
         self.assertTrue(script_executor._use_encryption)
 
-        # Create table for cluster_uuid1.
-        http_table1 = self.http_table_factory.create_table(test_utils.table_id1)
-        self.fake_vizier_service.add_fake_data(conn.cluster_id, [
-            # Initialize the table on the stream with the metadata.
-            http_table1.metadata_response(),
-            # Send over a single-row batch.
-            http_table1.row_batch_response([[b"foo"], [200]]),
-            # Send an end-of-stream for the table.
-            http_table1.end(),
-        ])
+        # Send the metadata, a single-row batch and an end-of-stream for "http".
+        self.fake_vizier_service.set_fake_data(conn.cluster_id, HTTP_META, HTTP_BATCH_FOO, HTTP_END)
 
         # Use the results API to run and get the data from the http table.
         for row in script_executor.results("http"):
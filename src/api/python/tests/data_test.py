@@ -98,8 +98,7 @@ class TestData(unittest.TestCase):
                 self.assertEqual(row["resp_status"], rb_data[1][i])
                 i += 1
 
-        loop = asyncio.get_event_loop()
-        loop.run_until_complete(process_rows())
+        asyncio.run(process_rows())
 
     def test_unsubbed_table_stream(self) -> None:
         # Create the table stream, but it should be unsubscribed.
@@ -124,9 +123,8 @@ class TestData(unittest.TestCase):
         table.add_row_batch(batch1)
         table.add_row_batch(batch2)
 
-        loop = asyncio.get_event_loop()
         with self.assertRaisesRegex(ValueError, "Table .* not subscribed"):
-            loop.run_until_complete(utils.iterate_and_pass(table))
+            asyncio.run(utils.iterate_and_pass(table))
 
 
 if __name__ == "__main__":
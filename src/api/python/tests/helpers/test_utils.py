@@ -15,7 +15,8 @@
 # SPDX-License-Identifier: Apache-2.0
 
 import grpc
-from typing import List, Any
+from collections.abc import Hashable
+from typing import Any, Dict, List, Optional
 import json
 from authlib.jose import JsonWebKey, JsonWebEncryption
 
@@ -117,17 +118,38 @@ def _make_column(column: List[Any], coltype: vpb.DataType) -> vpb.Column:
 
 
 class FakeTableFactory:
+    """
+    Creates fake tables with a shared relation. The tables, and the responses they
+    cache, are shared by every caller that asks for the same table ID, so the tests
+    must not mutate them.
+    """
+
     def __init__(self, name: str, relation: vpb.Relation):
         self.name = name
         self.relation = relation
+        self._tables: Dict[str, "FakeTable"] = {}
 
     def create_table(self, table_id: str) -> "FakeTable":
-        return FakeTable(self.name, self.relation, table_id)
+        if table_id not in self._tables:
+            self._tables[table_id] = FakeTable(self.name, self.relation, table_id)
+        return self._tables[table_id]
 
 
 class ExecResponse:
     def __init__(self, data: vpb.ExecuteScriptResponse):
         self.execute_script_response = data
+        self._serialized: Optional[bytes] = None
+
+    def serialized_script_response(self, opts: vpb.ExecuteScriptRequest.EncryptionOptions) -> bytes:
+        '''
+        Returns the wire bytes of `encrypted_script_response`. The unencrypted bytes
+        are cached since the response never changes.
+        '''
+        if opts is not None and self.execute_script_response.HasField("data"):
+            return self.encrypted_script_response(opts).SerializeToString()
+        if self._serialized is None:
+            self._serialized = self.execute_script_response.SerializeToString()
+        return self._serialized
 
     def encrypted_script_response(self, opts: vpb.ExecuteScriptRequest.EncryptionOptions) -> vpb.ExecuteScriptResponse:
         '''
@@ -141,6 +163,11 @@ class ExecResponse:
         if opts is None:
             return es_resp
 
+        # Encrypt a copy so the response can be shared across streams.
+        encrypted_resp = vpb.ExecuteScriptResponse()
+        encrypted_resp.CopyFrom(es_resp)
+        es_resp = encrypted_resp
+
         # Now we encrypt the batch.
         rb = es_resp.data.batch.SerializeToString()
         key = JsonWebKey.import_key(json.loads(opts.jwk_key))
@@ -162,6 +189,11 @@ class FakeTable:
         self.relation = relation
         self.id = id
 
+        # Responses are never mutated once built, so they're cached and shared.
+        self._metadata_response: Optional[ExecResponse] = None
+        self._end_response: Optional[ExecResponse] = None
+        self._row_batch_responses: Dict[Any, ExecResponse] = {}
+
     def _metadata(self) -> vpb.QueryMetadata:
         return vpb.QueryMetadata(name=self.name, id=self.id, relation=self.relation)
 
@@ -186,29 +218,48 @@ class FakeTable:
         )
 
     def metadata_response(self) -> ExecResponse:
-        return ExecResponse(data=vpb.ExecuteScriptResponse(status=_ok(), meta_data=self._metadata()))
-
-    def row_batch_response(self, cols: List[List[Any]]) -> ExecResponse:
+        if self._metadata_response is None:
+            self._metadata_response = ExecResponse(
+                data=vpb.ExecuteScriptResponse(status=_ok(), meta_data=self._metadata()))
+        return self._metadata_response
+
+    def row_batch_response(self, cols: List[List[Any]], eos: bool = False) -> ExecResponse:
+        """ Sends a row batch message. If `eos` is set, the batch also ends the stream. """
+        if not all(isinstance(v, Hashable) for c in cols for v in c):
+            # Column values such as UInt128 protos can't be used in the key, so the
+            # response isn't cached.
+            return self._row_batch_response(cols, eos)
+        # Equal values of different types, such as True and 1, build different columns.
+        key = (tuple(tuple((type(v), v) for v in c) for c in cols), eos)
+        resp = self._row_batch_responses.get(key)
+        if resp is None:
+            resp = self._row_batch_response(cols, eos)
+            self._row_batch_responses[key] = resp
+        return resp
+
+    def _row_batch_response(self, cols: List[List[Any]], eos: bool) -> ExecResponse:
         # Error out if the rowbatch does not have the right number of columns.
         return ExecResponse(
             data=vpb.ExecuteScriptResponse(
                 status=_ok(),
-                data=vpb.QueryData(batch=self.row_batch(cols))
+                data=vpb.QueryData(batch=self.row_batch(cols, eow=eos, eos=eos))
             ),
         )
 
     def end(self) -> ExecResponse:
         """ Sends an end stream message. """
-        return ExecResponse(
-            data=vpb.ExecuteScriptResponse(
-                status=_ok(),
-                data=vpb.QueryData(batch=self.row_batch(
-                    [[]] * len(self.relation.columns),
-                    eos=True,
-                    eow=True
-                )),
+        if self._end_response is None:
+            self._end_response = ExecResponse(
+                data=vpb.ExecuteScriptResponse(
+                    status=_ok(),
+                    data=vpb.QueryData(batch=self.row_batch(
+                        [[]] * len(self.relation.columns),
+                        eos=True,
+                        eow=True
+                    )),
+                )
             )
-        )
+        return self._end_response
 
 
 def create_metadata(table_name: str, table_id: str, relation: vpb.Relation) -> vpb.QueryMetadata: